@@ -1,10 +1,20 @@
 #!/usr/bin/env python3
 
+import os
 import sys
+import traceback
+from sys import intern
 from ruamel.yaml import YAML
 from pathlib import Path
-from typing import Dict, Any, List, Set
+from typing import Dict, Any, List, Set, Tuple
 import argparse
+import logging
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from contextlib import redirect_stdout
+from io import StringIO
+from itertools import islice
+
+logger = logging.getLogger(__name__)
 
 yaml = YAML()
 yaml.preserve_quotes = True
@@ -14,8 +24,9 @@ yaml.sequence_indent = 4
 
 def load_yaml_file(file_path: Path) -> Dict[str, Any]:
     try:
-        with open(file_path, 'r', encoding='utf-8') as file:
-            return yaml.load(file) or {}
+        with open(file_path, 'rb', buffering=0) as file:
+            content = file.read()
+        return yaml.load(content) or {}
     except Exception as e:
         print(f"Błąd podczas wczytywania {file_path}: {e}")
         return {}
@@ -32,17 +43,20 @@ def save_yaml_file(file_path: Path, data: Dict[str, Any]):
 
 def find_subdirectory_yaml_files_by_layer(parent_dir: Path) -> Dict[str, List[Path]]:
     layers = {}
-    for layer_dir in parent_dir.iterdir():
-        if layer_dir.is_dir() and layer_dir.name.startswith('ttom'):
-            layer_name = layer_dir.name
+    with os.scandir(parent_dir) as layer_entries:
+        for layer_entry in layer_entries:
+            if not (layer_entry.name.startswith('ttom') and layer_entry.is_dir()):
+                continue
+            layer_name = layer_entry.name
             yaml_files = []
 
             # Przeszukaj katalogi serwisów w danej warstwie
-            for service_dir in layer_dir.iterdir():
-                if service_dir.is_dir():
-                    values_file = service_dir / "values.yaml"
-                    if values_file.exists():
-                        yaml_files.append(values_file)
+            with os.scandir(layer_entry.path) as service_entries:
+                for service_entry in service_entries:
+                    if service_entry.is_dir():
+                        values_file = os.path.join(service_entry.path, "values.yaml")
+                        if os.path.exists(values_file):
+                            yaml_files.append(Path(values_file))
 
             if yaml_files:
                 layers[layer_name] = yaml_files
@@ -51,48 +65,42 @@ def find_subdirectory_yaml_files_by_layer(parent_dir: Path) -> Dict[str, List[Pa
 
 
 def flatten_dict(d: Dict[str, Any], parent_key: str = '', sep: str = '___') -> Dict[str, Any]:
-    items = []
-    for k, v in d.items():
-        new_key = f"{parent_key}{sep}{k}" if parent_key else k
-        if isinstance(v, dict):
-            items.extend(flatten_dict(v, new_key, sep=sep).items())
+    out = {}
+    stack = [(parent_key, iter(d.items()))]
+    while stack:
+        prefix, items = stack[-1]
+        for k, v in items:
+            if prefix:
+                new_key = intern(f"{prefix}{sep}{k}")
+            else:
+                new_key = intern(k) if type(k) is str else k
+            if isinstance(v, dict):
+                stack.append((new_key, iter(v.items())))
+                break
+            out[new_key] = v
         else:
-            items.append((new_key, v))
-    return dict(items)
+            stack.pop()
+    return out
 
 
 def unflatten_dict(d: Dict[str, Any], sep: str = '___') -> Dict[str, Any]:
     result = {}
     for key, value in d.items():
-        parts = key.split(sep)
+        path, _, final_key = key.rpartition(sep)
         current = result
-        for i, part in enumerate(parts[:-1]):
-            if part not in current:
-                current[part] = {}
-            elif not isinstance(current[part], dict):
-                current[part] = {}
-            current = current[part]
-
-        final_key = parts[-1]
-        if final_key in current and isinstance(current[final_key], dict) and not isinstance(value, dict):
+        if path:
+            for part in path.split(sep):
+                nxt = current.get(part)
+                if type(nxt) is not dict:
+                    nxt = current[part] = {}
+                current = nxt
+
+        if type(current.get(final_key)) is dict and type(value) is not dict:
             continue
-        elif final_key in current and not isinstance(current[final_key], dict) and isinstance(value, dict):
-            current[final_key] = value
-        else:
-            current[final_key] = value
+        current[final_key] = value
     return result
 
 
-def remove_keys_from_dict(d: Dict[str, Any], keys_to_remove: Set[str], sep: str = '___') -> Dict[str, Any]:
-    flat_dict = flatten_dict(d, sep=sep)
-
-    for key in list(flat_dict.keys()):
-        if key in keys_to_remove:
-            del flat_dict[key]
-
-    return unflatten_dict(flat_dict, sep=sep)
-
-
 def remove_keys_from_yaml(data: Dict[str, Any], keys_to_remove: Set[str], sep: str = '___') -> Dict[str, Any]:
     def remove_from_nested_dict(d: Dict[str, Any], prefix: str = '') -> Dict[str, Any]:
         result = type(d)()
@@ -114,85 +122,157 @@ def remove_keys_from_yaml(data: Dict[str, Any], keys_to_remove: Set[str], sep: s
     return remove_from_nested_dict(data)
 
 
-def find_common_values(yaml_files: List[Path]) -> Dict[str, Any]:
+def find_common_values(
+    yaml_files: List[Path],
+) -> Tuple[Dict[str, Any], Set[str], Dict[Path, Tuple[Dict[str, Any], Dict[str, Any]]]]:
     if not yaml_files:
-        return {}
+        return {}, set(), {}
 
     all_data = []
+    parsed_by_file = {}
     for yaml_file in yaml_files:
         data = load_yaml_file(yaml_file)
+        flattened = flatten_dict(data)
+        parsed_by_file[yaml_file] = (data, flattened)
         if data:
-            flattened = flatten_dict(data)
             all_data.append(flattened)
-            print(f"Plik {yaml_file.name}: {len(flattened)} kluczy")
+            logger.info("Plik %s: %d kluczy", yaml_file.name, len(flattened))
         else:
-            print(f"Ostrzeżenie: Plik {yaml_file} jest pusty lub nieprawidłowy")
+            logger.warning("Ostrzeżenie: Plik %s jest pusty lub nieprawidłowy", yaml_file)
 
     if not all_data:
-        return {}
+        return {}, set(), parsed_by_file
 
     common_items = {}
     first_data = all_data[0]
 
-    print(f"\nRozpoczynam porównywanie {len(first_data)} kluczy z pierwszego pliku...")
-    print(f"Przykładowe klucze z pierwszego pliku:")
-    for i, (key, value) in enumerate(first_data.items()):
-        if i < 5:  # Pokaż pierwsze 5 kluczy
-            print(f"  {key} = {value}")
-
-    sample_keys = list(first_data.keys())[:3]
-
-    for key in sample_keys:
-        value = first_data[key]
-        print(f"\nSzczegółowa analiza klucza: '{key}' = '{value}'")
-
-        matches = []
-        for i, data in enumerate(all_data):
-            if key in data:
-                data_value = data[key]
-                match = (data_value == value)
-                matches.append(match)
-                print(f"  Plik {i+1}: '{data_value}' -> Zgodny: {match}")
-            else:
-                matches.append(False)
-                print(f"  Plik {i+1}: BRAK KLUCZA")
+    logger.info("\nRozpoczynam porównywanie %d kluczy z pierwszego pliku...", len(first_data))
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Przykładowe klucze z pierwszego pliku:")
+        for key, value in islice(first_data.items(), 5):  # Pokaż pierwsze 5 kluczy
+            logger.debug("  %s = %s", key, value)
+
+        for key in islice(first_data, 3):
+            value = first_data[key]
+            logger.debug("\nSzczegółowa analiza klucza: '%s' = '%s'", key, value)
+
+            matches = []
+            for i, data in enumerate(all_data):
+                if key in data:
+                    data_value = data[key]
+                    match = (data_value == value)
+                    matches.append(match)
+                    logger.debug("  Plik %d: '%s' -> Zgodny: %s", i + 1, data_value, match)
+                else:
+                    matches.append(False)
+                    logger.debug("  Plik %d: BRAK KLUCZA", i + 1)
 
-        all_match = all(matches)
-        print(f"  Wszystkie zgodne: {all_match}")
+            logger.debug("  Wszystkie zgodne: %s", all(matches))
 
+    other_data = all_data[1:]
+    shared_keys = set(first_data).intersection(*other_data)
     for key, value in first_data.items():
-        if all(key in data and data[key] == value for data in all_data[1:]):
+        if key in shared_keys and all(data[key] == value for data in other_data):
             common_items[key] = value
 
-    print(f"\nZnaleziono {len(common_items)} wspólnych kluczy")
+    logger.info("\nZnaleziono %d wspólnych kluczy", len(common_items))
 
     if common_items:
-        print("Wspólne klucze:")
-        for key, value in list(common_items.items())[:10]:  # Pokaż pierwsze 10
-            print(f"  {key} = {value}")
+        logger.info("Wspólne klucze:")
+        for key, value in islice(common_items.items(), 10):  # Pokaż pierwsze 10
+            logger.info("  %s = %s", key, value)
 
-    return unflatten_dict(common_items)
+    return unflatten_dict(common_items), set(common_items), parsed_by_file
 
 
-def merge_dicts(dict1: Dict[str, Any], dict2: Dict[str, Any]) -> Dict[str, Any]:
-    result = dict1.copy()
-
-    for key, value in dict2.items():
-        if key in result and isinstance(result[key], dict) and isinstance(value, dict):
-            result[key] = merge_dicts(result[key], value)
+def merge_into(dest: Dict[str, Any], src: Dict[str, Any]) -> Dict[str, Any]:
+    for key, value in src.items():
+        existing = dest.get(key)
+        if type(value) is dict and isinstance(existing, dict):
+            merge_into(existing, value)
         else:
-            result[key] = value
+            dest[key] = value
+
+    return dest
+
+
+def process_layer(layer_name: str, yaml_files: List[Path], parent_dir: Path, dry_run: bool):
+    print(f"\n{'='*60}")
+    print(f"PRZETWARZAM WARSTWĘ: {layer_name}")
+    print(f"{'='*60}")
+
+    layer_dir = parent_dir / layer_name
+    layer_yaml_path = layer_dir / "values.yaml"
+
+    print(f"Katalog warstwy: {layer_dir}")
+    print(f"Plik values.yaml warstwy: {layer_yaml_path}")
+
+    if not layer_yaml_path.exists():
+        print(f"Ostrzeżenie: Plik {layer_yaml_path} nie istnieje - zostanie utworzony")
+        layer_data = {}
+    else:
+        layer_data = load_yaml_file(layer_yaml_path)
+        print(f"Wczytano istniejący plik warstwy z {len(flatten_dict(layer_data))} kluczami")
+
+    print(f"\nSzukanie wspólnych wartości dla warstwy {layer_name}...")
+    common_values, common_keys, parsed_by_file = find_common_values(yaml_files)
+
+    if not common_values:
+        print(f"Nie znaleziono wspólnych wartości dla warstwy {layer_name}.")
+        return
+
+    print(f"\nZnaleziono wspólne wartości dla warstwy {layer_name}:")
+    output = StringIO()
+    yaml.dump(common_values, output)
+    print(output.getvalue())
+
+    if dry_run:
+        print(f"TRYB TESTOWY - plik warstwy {layer_name} nie został zmieniony.")
+    else:
+        merge_into(layer_data, common_values)
+
+        save_yaml_file(layer_yaml_path, layer_data)
+
+        print(f"\nUsuwam wspólne wartości z {len(yaml_files)} plików serwisów w warstwie {layer_name}...")
+        for yaml_file in yaml_files:
+            data, flattened = parsed_by_file[yaml_file]
+            if common_keys.isdisjoint(flattened):
+                continue
+            updated_data = remove_keys_from_yaml(data, common_keys)
+            save_yaml_file(yaml_file, updated_data)
+
+        print(f"Pomyślnie przeniesiono wspólne wartości do {layer_yaml_path}")
 
-    return result
+
+def process_layer_captured(layer_name: str, yaml_files: List[Path], parent_dir: Path,
+                           dry_run: bool, log_level: int) -> Tuple[str, bool]:
+    # Każdy proces zbiera swoje wyjście osobno, aby logi warstw się nie przeplatały
+    output = StringIO()
+    with redirect_stdout(output):
+        logging.basicConfig(level=log_level, format='%(message)s', stream=sys.stdout, force=True)
+        try:
+            process_layer(layer_name, yaml_files, parent_dir, dry_run)
+        except Exception:
+            traceback.print_exc(file=output)
+            return output.getvalue(), False
+    return output.getvalue(), True
 
 
 def main():
     parser = argparse.ArgumentParser(description='Przenieś wspólne wartości YAML do pliku nadrzędnego')
     parser.add_argument('parent_directory', help='Ścieżka do katalogu nadrzędnego zawierającego values.yaml')
     parser.add_argument('--dry-run', action='store_true', help='Pokaż co zostanie zmienione bez zapisywania')
+    parser.add_argument('--verbose', action='store_true', help='Pokaż szczegółową analizę porównywanych kluczy')
 
     args = parser.parse_args()
 
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(message)s',
+        stream=sys.stdout,
+    )
+
     print(f"Rozpoczynam analizę katalogu: {args.parent_directory}")
 
     parent_dir = Path(args.parent_directory)
@@ -216,53 +296,38 @@ def main():
         for yaml_file in yaml_files:
             print(f"    - {yaml_file.name}")
 
-    for layer_name, yaml_files in layers_yaml_files.items():
-        print(f"\n{'='*60}")
-        print(f"PRZETWARZAM WARSTWĘ: {layer_name}")
-        print(f"{'='*60}")
-
-        layer_dir = parent_dir / layer_name
-        layer_yaml_path = layer_dir / "values.yaml"
-
-        print(f"Katalog warstwy: {layer_dir}")
-        print(f"Plik values.yaml warstwy: {layer_yaml_path}")
-
-        if not layer_yaml_path.exists():
-            print(f"Ostrzeżenie: Plik {layer_yaml_path} nie istnieje - zostanie utworzony")
-            layer_data = {}
-        else:
-            layer_data = load_yaml_file(layer_yaml_path)
-            print(f"Wczytano istniejący plik warstwy z {len(flatten_dict(layer_data))} kluczami")
-
-        print(f"\nSzukanie wspólnych wartości dla warstwy {layer_name}...")
-        common_values = find_common_values(yaml_files)
-
-        if not common_values:
-            print(f"Nie znaleziono wspólnych wartości dla warstwy {layer_name}.")
-            continue
-
-        print(f"\nZnaleziono wspólne wartości dla warstwy {layer_name}:")
-        from io import StringIO
-        output = StringIO()
-        yaml.dump(common_values, output)
-        print(output.getvalue())
-
-        if args.dry_run:
-            print(f"TRYB TESTOWY - plik warstwy {layer_name} nie został zmieniony.")
-        else:
-            updated_layer_data = merge_dicts(layer_data, common_values)
-
-            save_yaml_file(layer_yaml_path, updated_layer_data)
-
-            common_keys = set(flatten_dict(common_values).keys())
-
-            print(f"\nUsuwam wspólne wartości z {len(yaml_files)} plików serwisów w warstwie {layer_name}...")
-            for yaml_file in yaml_files:
-                data = load_yaml_file(yaml_file)
-                updated_data = remove_keys_from_yaml(data, common_keys)
-                save_yaml_file(yaml_file, updated_data)
-
-            print(f"Pomyślnie przeniesiono wspólne wartości do {layer_yaml_path}")
+    max_workers = min(os.cpu_count() or 1, len(layers_yaml_files))
+    if max_workers == 1:
+        for layer_name, yaml_files in layers_yaml_files.items():
+            process_layer(layer_name, yaml_files, parent_dir, args.dry_run)
+    else:
+        failed_layers = []
+        remaining_layers = iter(layers_yaml_files.items())
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            in_flight = {}
+
+            # Zlecaj tylko tyle warstw, ile jest procesów, aby po błędzie nie startowały kolejne
+            def submit_layers(count: int):
+                for layer_name, yaml_files in islice(remaining_layers, count):
+                    future = executor.submit(process_layer_captured, layer_name, yaml_files, parent_dir,
+                                             args.dry_run, logger.getEffectiveLevel())
+                    in_flight[future] = layer_name
+
+            submit_layers(max_workers)
+            while in_flight:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    layer_name = in_flight.pop(future)
+                    layer_output, succeeded = future.result()
+                    print(layer_output, end='')
+                    if not succeeded:
+                        failed_layers.append(layer_name)
+                if not failed_layers:
+                    submit_layers(len(done))
+
+        if failed_layers:
+            print(f"\nBłąd: nie udało się przetworzyć warstw: {', '.join(failed_layers)}")
+            sys.exit(1)
 
     if args.dry_run:
         print(f"\n{'='*60}")